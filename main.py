@@ -1,31 +1,74 @@
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+import orjson
 import yt_dlp
 import os
-import uuid
+import secrets
 from pathlib import Path
+from urllib.parse import quote
 import asyncio
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+import sqlite3
 import csv
+import time
 from datetime import datetime, timedelta
 import shutil
 import threading
 
-app = FastAPI(title="YouTube Downloader")
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse serialized with orjson instead of the stdlib json module"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+class LargeFileResponse(FileResponse):
+    """FileResponse that streams in 1MB chunks to cut syscalls on large media files"""
+    chunk_size = 1024 * 1024
+
+
+app = FastAPI(title="YouTube Downloader", default_response_class=ORJSONResponse)
 
 # Create necessary directories
 DOWNLOADS_DIR = Path("downloads")
 DOWNLOADS_DIR.mkdir(exist_ok=True)
 
-# Cache file for tracking downloads
-CACHE_FILE = DOWNLOADS_DIR / "download_cache.csv"
+# Cache database for tracking downloads
+CACHE_DB = DOWNLOADS_DIR / "cache.db"
+LEGACY_CACHE_FILE = DOWNLOADS_DIR / "download_cache.csv"  # Imported once, then removed
 CACHE_DURATION = timedelta(minutes=30)  # Files kept for 30 minutes
 
-# CSV lock for thread safety
-cache_lock = threading.Lock()
+# When set (e.g. "/protected-downloads/"), /file responses hand delivery to an
+# nginx internal location via X-Accel-Redirect instead of streaming from Python
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX")
+
+# In-memory index over the cache: (url, format_type) -> (download_id, file_name, file_path, expiry)
+# The database is only the durable backing store; lookups never touch disk.
+CACHE_INDEX: dict[tuple[str, str], tuple[str, str, str, float]] = {}
+
+# Striped locks keep index and database updates for one URL consistent
+# without serializing downloads of different URLs
+LOCK_STRIPES = [threading.Lock() for _ in range(64)]
+
+# Periodic cleanup, scheduled on the event loop's monotonic timer
+CLEANUP_INTERVAL = 300  # Run every 5 minutes
+_cleanup_handle: Optional[asyncio.TimerHandle] = None
+_cleanup_task: Optional[asyncio.Task] = None
+
+# Cache rows waiting to be written to SQLite in one batched transaction
+_pending_rows: deque = deque()
+_flush_event = threading.Event()
+_flush_lock = threading.Lock()
+FLUSH_INTERVAL = 2  # Seconds between background flushes
+FLUSH_BATCH_SIZE = 16  # Flush early once this many rows are pending
+
+# Per-thread SQLite connections (WAL lets readers and the writer run concurrently)
+_db_local = threading.local()
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -33,172 +76,508 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Setup templates
 templates = Jinja2Templates(directory="templates")
 
-# Thread pool for async downloads
-executor = ThreadPoolExecutor(max_workers=3)
+# Recently extracted video info: url -> (extract_time, info)
+# Reused by /download so the common /info then /download flow fetches YouTube once
+INFO_CACHE: dict[str, tuple[float, dict]] = {}
+INFO_CACHE_TTL = 300  # Seconds, well under the expiry of YouTube format URLs
+INFO_CACHE_MAX = 256  # Entries kept per worker; info dicts list every format and are large
+_info_cache_lock = threading.Lock()
+
+# Audio size estimates in MB per second of duration (kbps / 8 / 1024)
+MP3_320_MB_PER_SEC = 320 / 8192
+MP3_192_MB_PER_SEC = 192 / 8192
+WAV_MB_PER_SEC = 1411 / 8192  # 16-bit stereo
+
+
+def _mp4_format_string(height: str) -> str:
+    """Build the yt-dlp format selector for an MP4 capped at the given height"""
+    return f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}][ext=mp4]/best'
+
+
+# Precomputed MP4 format selectors by requested quality (None means best)
+MP4_FORMATS: dict[Optional[str], str] = {
+    quality: _mp4_format_string(quality[:-1])
+    for quality in ('360p', '480p', '720p', '1080p', '1440p', '2160p')
+}
+MP4_FORMATS[None] = 'best[ext=mp4]/bestvideo[ext=mp4]+bestaudio[ext=m4a]/best'
+
+# Long-lived YoutubeDL instances, one set per worker thread so they are never shared
+_ydl_local = threading.local()
+MAX_YDL_PROFILES = 16  # Download profiles kept per thread
+
+# Separate thread pools so short metadata lookups never queue behind downloads
+info_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="ytinfo")
+download_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ytdl")
+
+# Throttle concurrent downloads before they reach the download pool
+download_semaphore = asyncio.Semaphore(4)
+
+
+def get_db() -> sqlite3.Connection:
+    """Get the SQLite connection for the current thread"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(CACHE_DB, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    return conn
+
+
+def _lock_for(url: str) -> threading.Lock:
+    """Get the lock stripe guarding cache entries for a URL"""
+    return LOCK_STRIPES[hash(url) & 63]
 
 
 def init_cache_file():
-    """Initialize cache CSV file if it doesn't exist"""
-    if not CACHE_FILE.exists():
-        with open(CACHE_FILE, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['url', 'download_id', 'file_name', 'file_path', 'download_time', 'format_type'])
+    """Initialize cache database if it doesn't exist and load the in-memory index"""
+    conn = get_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                download_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                format_type TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                download_time REAL NOT NULL
+            )
+        """)
+        # One row per download, so cleanup sees every file even when a URL is re-downloaded
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_downloads_lookup "
+            "ON downloads (url, format_type, download_time)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_time ON downloads (download_time)")
+
+    import_legacy_cache()
+
+    duration = CACHE_DURATION.total_seconds()
+    # Oldest first, so the newest download of each URL ends up in the index
+    for row in conn.execute("SELECT * FROM downloads ORDER BY download_time"):
+        CACHE_INDEX[(row['url'], row['format_type'])] = (
+            row['download_id'],
+            row['file_name'],
+            row['file_path'],
+            row['download_time'] + duration
+        )
+
+
+def import_legacy_cache():
+    """Move entries from the old CSV cache into the database so cleanup still removes their files"""
+    if not LEGACY_CACHE_FILE.exists():
+        return
+
+    rows = []
+    try:
+        with open(LEGACY_CACHE_FILE, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                try:
+                    rows.append((
+                        row['download_id'],
+                        row['url'],
+                        row['format_type'],
+                        row['file_name'],
+                        row['file_path'],
+                        datetime.fromisoformat(row['download_time']).timestamp()
+                    ))
+                except Exception as e:
+                    print(f"Error importing legacy cache entry: {e}")
+
+        conn = get_db()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO downloads "
+                "(download_id, url, format_type, file_name, file_path, download_time) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        LEGACY_CACHE_FILE.unlink(missing_ok=True)
+        print(f"Imported {len(rows)} entries from {LEGACY_CACHE_FILE.name}")
+    except Exception as e:
+        print(f"Legacy cache import error: {e}")
+
+
+def _cache_result(entry: tuple[str, str, str, float]) -> Optional[dict]:
+    """Build a cache hit from an index entry if it is within cache duration"""
+    # Files only disappear through cleanup, which also drops their index entries
+    if entry[3] > time.time():
+        return {
+            'download_id': entry[0],
+            'file_name': entry[1],
+            'file_path': entry[2],
+            'cached': True
+        }
+
+    return None
 
 
 def check_cache(url: str, format_type: str) -> Optional[dict]:
     """Check if URL exists in cache and file is still valid (less than 30 minutes old)"""
-    if not CACHE_FILE.exists():
+    entry = CACHE_INDEX.get((url, format_type))
+    return _cache_result(entry) if entry else None
+
+
+def check_shared_cache(url: str, format_type: str) -> Optional[dict]:
+    """Check the shared database for a download made by another worker process"""
+    key = (url, format_type)
+    try:
+        row = get_db().execute(
+            "SELECT download_id, file_name, file_path, download_time FROM downloads "
+            "WHERE url = ? AND format_type = ? ORDER BY download_time DESC LIMIT 1",
+            key
+        ).fetchone()
+    except Exception as e:
+        print(f"Cache check error: {e}")
         return None
-    
-    with cache_lock:
-        try:
-            with open(CACHE_FILE, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row['url'] == url and row['format_type'] == format_type:
-                        download_time = datetime.fromisoformat(row['download_time'])
-                        age = datetime.now() - download_time
-                        
-                        # Check if file still exists and is within cache duration
-                        file_path = Path(row['file_path'])
-                        if age < CACHE_DURATION and file_path.exists():
-                            return {
-                                'download_id': row['download_id'],
-                                'file_name': row['file_name'],
-                                'file_path': row['file_path'],
-                                'cached': True
-                            }
-        except Exception as e:
-            print(f"Cache check error: {e}")
-            return None
-    
-    return None
+    if row is None:
+        return None
+
+    entry = (
+        row['download_id'],
+        row['file_name'],
+        row['file_path'],
+        row['download_time'] + CACHE_DURATION.total_seconds()
+    )
+    with _lock_for(url):
+        current = CACHE_INDEX.get(key)
+        if current is None or current[3] < entry[3]:
+            CACHE_INDEX[key] = entry
+
+    return _cache_result(entry)
 
 
 def add_to_cache(url: str, download_id: str, file_name: str, file_path: str, format_type: str):
     """Add successful download to cache"""
-    with cache_lock:
+    download_time = time.time()
+
+    with _lock_for(url):
+        CACHE_INDEX[(url, format_type)] = (
+            download_id,
+            file_name,
+            file_path,
+            download_time + CACHE_DURATION.total_seconds()
+        )
+
+        _pending_rows.append((url, format_type, download_id, file_name, file_path, download_time))
+
+    if len(_pending_rows) >= FLUSH_BATCH_SIZE:
+        _flush_event.set()
+
+
+def flush_cache():
+    """Write all pending cache rows to the database in a single transaction"""
+    with _flush_lock:
+        rows = []
+        while _pending_rows:
+            rows.append(_pending_rows.popleft())
+        if not rows:
+            return
+
         try:
-            with open(CACHE_FILE, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    url,
-                    download_id,
-                    file_name,
-                    file_path,
-                    datetime.now().isoformat(),
-                    format_type
-                ])
+            conn = get_db()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO downloads "
+                    "(url, format_type, download_id, file_name, file_path, download_time) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
         except Exception as e:
             print(f"Cache add error: {e}")
+            # Put the batch back in order so the next flush retries it
+            _pending_rows.extendleft(reversed(rows))
 
 
-def cleanup_old_files():
-    """Remove files and entries older than 30 minutes"""
-    if not CACHE_FILE.exists():
+def _flush_worker():
+    """Background thread flushing pending cache rows every few seconds"""
+    while True:
+        _flush_event.wait(FLUSH_INTERVAL)
+        _flush_event.clear()
+        flush_cache()
+
+
+def expire_cache_entries() -> list:
+    """Remove entries older than 30 minutes from the cache and return them"""
+    flush_cache()
+
+    # Drop stale video info
+    with _info_cache_lock:
+        _prune_info_cache()
+
+    try:
+        # Select and delete expired entries in one transaction, both using the
+        # download_time index (no DELETE ... RETURNING, which needs SQLite 3.35)
+        conn = get_db()
+        cutoff = time.time() - CACHE_DURATION.total_seconds()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            expired = conn.execute(
+                "SELECT url, format_type, download_id, file_name, file_path "
+                "FROM downloads WHERE download_time <= ?",
+                (cutoff,)
+            ).fetchall()
+            conn.execute("DELETE FROM downloads WHERE download_time <= ?", (cutoff,))
+    except Exception as e:
+        print(f"Cleanup error: {e}")
+        return []
+
+    for row in expired:
+        # Drop the index entry unless it was replaced by a newer download
+        key = (row['url'], row['format_type'])
+        with _lock_for(row['url']):
+            entry = CACHE_INDEX.get(key)
+            if entry and entry[0] == row['download_id']:
+                del CACHE_INDEX[key]
+
+    return expired
+
+
+def verify_cache_entries():
+    """Drop cache entries whose files were removed outside of cleanup"""
+    missing = [
+        (key, entry[0]) for key, entry in list(CACHE_INDEX.items())
+        if not os.path.exists(entry[2])
+    ]
+    if not missing:
         return
-    
-    with cache_lock:
+
+    for key, download_id in missing:
+        with _lock_for(key[0]):
+            entry = CACHE_INDEX.get(key)
+            if entry and entry[0] == download_id:
+                del CACHE_INDEX[key]
+
+    try:
+        conn = get_db()
+        with conn:
+            conn.executemany(
+                "DELETE FROM downloads WHERE url = ? AND format_type = ? AND download_id = ?",
+                [(url, format_type, download_id) for (url, format_type), download_id in missing]
+            )
+    except Exception as e:
+        print(f"Cache verify error: {e}")
+
+    for _, download_id in missing:
         try:
-            # Read all entries
-            with open(CACHE_FILE, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-            
-            # Filter valid entries and delete old ones
-            valid_rows = []
-            current_time = datetime.now()
-            
-            for row in rows:
-                try:
-                    download_time = datetime.fromisoformat(row['download_time'])
-                    age = current_time - download_time
-                    
-                    if age >= CACHE_DURATION:
-                        # Delete the file and directory
-                        file_path = Path(row['file_path'])
-                        if file_path.exists():
-                            file_path.unlink()
-                        
-                        # Delete the download directory if empty
-                        download_dir = DOWNLOADS_DIR / row['download_id']
-                        if download_dir.exists() and not any(download_dir.iterdir()):
-                            download_dir.rmdir()
-                        
-                        print(f"Cleaned up old download: {row['file_name']}")
-                    else:
-                        valid_rows.append(row)
-                except Exception as e:
-                    print(f"Error cleaning entry: {e}")
-                    # Keep the row if there's an error
-                    valid_rows.append(row)
-            
-            # Rewrite cache file with valid entries
-            with open(CACHE_FILE, 'w', newline='', encoding='utf-8') as f:
-                if valid_rows:
-                    writer = csv.DictWriter(f, fieldnames=['url', 'download_id', 'file_name', 'file_path', 'download_time', 'format_type'])
-                    writer.writeheader()
-                    writer.writerows(valid_rows)
-                else:
-                    # Write header only
-                    writer = csv.writer(f)
-                    writer.writerow(['url', 'download_id', 'file_name', 'file_path', 'download_time', 'format_type'])
-        
+            _remove_download_dir(download_id)
         except Exception as e:
-            print(f"Cleanup error: {e}")
+            print(f"Error cleaning entry: {e}")
 
 
-async def periodic_cleanup():
-    """Background task to clean up old files every 5 minutes"""
-    while True:
-        await asyncio.sleep(300)  # Run every 5 minutes
-        cleanup_old_files()
+def _remove_download_dir(download_id: str):
+    """Delete a download's directory if it is empty"""
+    download_dir = DOWNLOADS_DIR / download_id
+    if download_dir.exists() and not any(download_dir.iterdir()):
+        download_dir.rmdir()
 
 
-def get_video_info(url: str) -> dict:
-    """Get video information including available formats"""
+def _delete_one(row: sqlite3.Row):
+    """Delete an expired download's file and its directory"""
     try:
-        ydl_opts = {
+        # Delete the file and directory
+        Path(row['file_path']).unlink(missing_ok=True)
+
+        # Delete the download directory if empty
+        _remove_download_dir(row['download_id'])
+
+        print(f"Cleaned up old download: {row['file_name']}")
+    except Exception as e:
+        print(f"Error cleaning entry: {e}")
+
+
+async def cleanup_old_files():
+    """Remove files and entries older than 30 minutes"""
+    expired = await asyncio.to_thread(expire_cache_entries)
+
+    # Every download has its own directory, so deletions are independent
+    # and can run in parallel without any lock
+    await asyncio.gather(*(asyncio.to_thread(_delete_one, row) for row in expired))
+
+    await asyncio.to_thread(verify_cache_entries)
+
+
+def _report_cleanup_error(task: asyncio.Task):
+    """Retrieve and log an exception from a finished cleanup task"""
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Cleanup error: {task.exception()}")
+
+
+def schedule_cleanup(loop: asyncio.AbstractEventLoop, when: float):
+    """Run cleanup at a fixed monotonic deadline, then reschedule one interval later"""
+    global _cleanup_handle, _cleanup_task
+
+    def run():
+        global _cleanup_task
+        # Skip this tick if the previous cleanup is still running
+        if _cleanup_task is None or _cleanup_task.done():
+            _cleanup_task = loop.create_task(cleanup_old_files())
+            _cleanup_task.add_done_callback(_report_cleanup_error)
+        schedule_cleanup(loop, when + CLEANUP_INTERVAL)
+
+    _cleanup_handle = loop.call_at(when, run)
+
+
+def _prune_info_cache():
+    """Drop stale and over-limit video info; callers hold _info_cache_lock"""
+    # Entries are kept in insertion order, so the oldest is always first
+    now = time.time()
+    while INFO_CACHE:
+        oldest_url, (extract_time, _) = next(iter(INFO_CACHE.items()))
+        if len(INFO_CACHE) <= INFO_CACHE_MAX and now - extract_time < INFO_CACHE_TTL:
+            break
+        del INFO_CACHE[oldest_url]
+
+
+def cache_video_info(url: str, info: dict):
+    """Store extracted video info for reuse by /download"""
+    with _info_cache_lock:
+        # Re-insert so a refreshed URL moves to the newest end
+        INFO_CACHE.pop(url, None)
+        INFO_CACHE[url] = (time.time(), info)
+        _prune_info_cache()
+
+
+def get_info_ydl() -> yt_dlp.YoutubeDL:
+    """Get the metadata YoutubeDL instance for the current thread"""
+    ydl = getattr(_ydl_local, 'info', None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL({
             'quiet': True,
             'no_warnings': True,
+        })
+        _ydl_local.info = ydl
+    return ydl
+
+
+def _normalize_quality(format_type: str, quality: Optional[str]) -> Optional[str]:
+    """Reduce the user-supplied quality to a canonical value, or None for the default"""
+    digits = (quality or '').strip().lower().removesuffix('p')
+    if format_type == "mp3":
+        # Bitrate in kbps
+        return digits if digits.isdigit() and 0 < int(digits) <= 320 else None
+    if format_type == "mp4":
+        # Video height, e.g. "720p"
+        return f"{int(digits)}p" if digits.isdigit() and 0 < int(digits) <= 4320 else None
+    return None  # WAV output ignores quality
+
+
+def get_download_ydl(format_type: str, quality: Optional[str]) -> yt_dlp.YoutubeDL:
+    """Get the current thread's YoutubeDL instance for a format/quality profile"""
+    quality = _normalize_quality(format_type, quality)
+    profile = (format_type, quality)
+
+    downloaders = getattr(_ydl_local, 'downloaders', None)
+    if downloaders is None:
+        downloaders = _ydl_local.downloaders = {}
+
+    ydl = downloaders.get(profile)
+    if ydl is not None:
+        return ydl
+
+    if format_type == "mp3":
+        # MP3 Audio (320kbps)
+        bitrate = quality if quality else "320"
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': bitrate,
+            }],
+            'quiet': False,
+            'no_warnings': False,
+            'concurrent_fragment_downloads': 8,  # Overlap DASH/HLS fragment fetches
+            'socket_timeout': 15,  # Fail fast on stalled fragments
         }
+    elif format_type == "wav":
+        # WAV Audio (16-bit)
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'wav',
+            }],
+            'postprocessor_args': [
+                '-ar', '44100',  # Sample rate
+                '-ac', '2',       # Stereo
+                '-sample_fmt', 's16'  # 16-bit
+            ],
+            'quiet': False,
+            'no_warnings': False,
+            'concurrent_fragment_downloads': 8,  # Overlap DASH/HLS fragment fetches
+            'socket_timeout': 15,  # Fail fast on stalled fragments
+        }
+    else:  # mp4
+        # Video with quality selection
+        format_string = MP4_FORMATS.get(quality)
+        if format_string is None:
+            # Uncommon quality requested
+            format_string = _mp4_format_string(quality[:-1])
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            # Get video formats
-            formats = info.get('formats', [])
-            
-            # Find best quality options
-            video_formats = {}
-            for f in formats:
-                if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                    height = f.get('height')
-                    filesize = f.get('filesize') or f.get('filesize_approx', 0)
-                    if height and height >= 360:
-                        quality = f"{height}p"
-                        if quality not in video_formats or filesize > video_formats[quality].get('size', 0):
-                            video_formats[quality] = {
-                                'quality': quality,
-                                'size': filesize,
-                                'size_mb': round(filesize / (1024 * 1024), 1) if filesize else 0
-                            }
-            
-            # Estimate audio sizes (approximate)
-            duration = info.get('duration', 0)
-            
-            return {
-                "success": True,
-                "title": info.get('title', 'Unknown'),
-                "duration": duration,
-                "thumbnail": info.get('thumbnail'),
-                "video_formats": sorted(video_formats.values(), key=lambda x: int(x['quality'].replace('p', '')), reverse=True),
-                "audio_estimates": {
-                    "mp3_320": round(duration * 320 / 8 / 1024, 1) if duration else 0,  # MB
-                    "mp3_192": round(duration * 192 / 8 / 1024, 1) if duration else 0,
-                    "wav": round(duration * 1411 / 8 / 1024, 1) if duration else 0,  # 16-bit stereo
-                }
+        ydl_opts = {
+            'format': format_string,
+            'merge_output_format': 'mp4',
+            'quiet': False,
+            'no_warnings': False,
+            'concurrent_fragment_downloads': 8,  # Overlap DASH/HLS fragment fetches
+            'socket_timeout': 15,  # Fail fast on stalled fragments
+        }
+
+    if len(downloaders) >= MAX_YDL_PROFILES:
+        # Evict the oldest profile to bound memory, releasing its connections
+        downloaders.pop(next(iter(downloaders))).close()
+    ydl = downloaders[profile] = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl
+
+
+def get_video_info(url: str) -> dict:
+    """Get video information including available formats"""
+    try:
+        ydl = get_info_ydl()
+        info = ydl.extract_info(url, download=False)
+        cache_video_info(url, info)
+        
+        # Get video formats
+        formats = info.get('formats', [])
+        
+        # Find best quality options: height -> largest filesize
+        best_sizes: dict[int, int] = {}
+        candidates = (
+            f for f in formats
+            if f.get('vcodec') != 'none' and f.get('acodec') != 'none' and (f.get('height') or 0) >= 360
+        )
+        for f in candidates:
+            height = f['height']
+            filesize = f.get('filesize') or f.get('filesize_approx') or 0
+            if filesize > best_sizes.get(height, -1):
+                best_sizes[height] = filesize
+        
+        video_formats = [
+            {
+                'quality': f"{height}p",
+                'size': size,
+                'size_mb': round(size / (1024 * 1024), 1) if size else 0
+            }
+            for height, size in sorted(best_sizes.items(), reverse=True)
+        ]
+        
+        # Estimate audio sizes (approximate)
+        duration = info.get('duration', 0)
+        
+        return {
+            "success": True,
+            "title": info.get('title', 'Unknown'),
+            "duration": duration,
+            "thumbnail": info.get('thumbnail'),
+            "video_formats": video_formats,
+            "audio_estimates": {
+                "mp3_320": round(duration * MP3_320_MB_PER_SEC, 1) if duration else 0,  # MB
+                "mp3_192": round(duration * MP3_192_MB_PER_SEC, 1) if duration else 0,
+                "wav": round(duration * WAV_MB_PER_SEC, 1) if duration else 0,
             }
+        }
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -208,82 +587,33 @@ def download_video(url: str, format_type: str, output_id: str, quality: Optional
     try:
         output_path = DOWNLOADS_DIR / output_id
         
-        if format_type == "mp3":
-            # MP3 Audio (320kbps)
-            bitrate = quality if quality else "320"
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': bitrate,
-                }],
-                'outtmpl': str(output_path / '%(title)s.%(ext)s'),
-                'quiet': False,
-                'no_warnings': False,
-            }
-        elif format_type == "wav":
-            # WAV Audio (16-bit)
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'wav',
-                }],
-                'postprocessor_args': [
-                    '-ar', '44100',  # Sample rate
-                    '-ac', '2',       # Stereo
-                    '-sample_fmt', 's16'  # 16-bit
-                ],
-                'outtmpl': str(output_path / '%(title)s.%(ext)s'),
-                'quiet': False,
-                'no_warnings': False,
-            }
-        else:  # mp4
-            # Video with quality selection
-            if quality:
-                # Specific quality requested
-                quality_num = quality.replace('p', '')
-                format_string = f'bestvideo[height<={quality_num}][ext=mp4]+bestaudio[ext=m4a]/best[height<={quality_num}][ext=mp4]/best'
-            else:
-                # Best quality
-                format_string = 'best[ext=mp4]/bestvideo[ext=mp4]+bestaudio[ext=m4a]/best'
-            
-            ydl_opts = {
-                'format': format_string,
-                'outtmpl': str(output_path / '%(title)s.%(ext)s'),
-                'merge_output_format': 'mp4',
-                'quiet': False,
-                'no_warnings': False,
-            }
+        # Instances are thread-local, so the output template can be set per call
+        ydl = get_download_ydl(format_type, quality)
+        ydl.params['outtmpl']['default'] = str(output_path / '%(title)s.%(ext)s')
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        cached = INFO_CACHE.get(url)
+        if (cached and time.time() - cached[0] < INFO_CACHE_TTL
+                and cached[1].get('_type', 'video') == 'video'):
+            # Reuse info from /info, letting yt-dlp redo format selection;
+            # playlists are re-extracted since sanitizing drops their entries
+            info = ydl.process_ie_result(
+                ydl.sanitize_info(cached[1], remove_private_keys=True),
+                download=True
+            )
+        else:
             info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'video')
-            
-            # Find the downloaded file
-            files = list(output_path.glob(f"*{title}*"))
-            if files:
-                downloaded_file = files[0]
-                return {
-                    "success": True,
-                    "file_path": str(downloaded_file),
-                    "file_name": downloaded_file.name,
-                    "title": title
-                }
-            else:
-                # Fallback: find any file in the directory
-                extensions = ['mp3', 'wav', 'mp4']
-                for ext in extensions:
-                    files = list(output_path.glob(f"*.{ext}"))
-                    if files:
-                        downloaded_file = files[0]
-                        return {
-                            "success": True,
-                            "file_path": str(downloaded_file),
-                            "file_name": downloaded_file.name,
-                            "title": title
-                        }
+        title = info.get('title', 'video')
+        
+        # Find the downloaded file (the output directory is unique per download)
+        with os.scandir(output_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    return {
+                        "success": True,
+                        "file_path": entry.path,
+                        "file_name": entry.name,
+                        "title": title
+                    }
         
         return {"success": False, "error": "File not found after download"}
     
@@ -301,8 +631,8 @@ async def home(request: Request):
 async def get_info(url: str = Form(...)):
     """Get video information"""
     loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(executor, get_video_info, url)
-    return JSONResponse(content=result)
+    result = await loop.run_in_executor(info_executor, get_video_info, url)
+    return ORJSONResponse(content=result)
 
 
 @app.post("/download")
@@ -313,16 +643,20 @@ async def download(
 ):
     """Handle download request"""
     if format not in ["mp4", "mp3", "wav"]:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"success": False, "error": "Invalid format. Choose mp4, mp3, or wav."}
         )
     
-    # Check if file exists in cache
+    loop = asyncio.get_event_loop()
+
+    # Check if file exists in cache; on a miss, query the shared database off the event loop
     cached_result = check_cache(url, format)
+    if not cached_result:
+        cached_result = await loop.run_in_executor(None, check_shared_cache, url, format)
     if cached_result:
         print(f"Serving cached file: {cached_result['file_name']}")
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "success": True,
             "message": f"Serving cached file",
             "download_url": f"/file/{cached_result['download_id']}/{cached_result['file_name']}",
@@ -330,18 +664,18 @@ async def download(
         })
     
     # Generate unique ID for this download
-    download_id = str(uuid.uuid4())
+    download_id = secrets.token_urlsafe(12)
     
     # Run download in thread pool
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(
-        executor,
-        download_video,
-        url,
-        format,
-        download_id,
-        quality
-    )
+    async with download_semaphore:
+        result = await loop.run_in_executor(
+            download_executor,
+            download_video,
+            url,
+            format,
+            download_id,
+            quality
+        )
     
     if result["success"]:
         # Add to cache
@@ -353,14 +687,14 @@ async def download(
             format
         )
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "success": True,
             "message": f"Downloaded: {result['title']}",
             "download_url": f"/file/{download_id}/{result['file_name']}",
             "cached": False
         })
     else:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"success": False, "error": result["error"]}
         )
@@ -372,12 +706,20 @@ async def get_file(download_id: str, file_name: str):
     file_path = DOWNLOADS_DIR / download_id / file_name
     
     if not file_path.exists():
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404,
             content={"error": "File not found"}
         )
     
-    return FileResponse(
+    if ACCEL_REDIRECT_PREFIX:
+        # Let nginx serve the file with sendfile/aio, keeping Python off the data path
+        return Response(headers={
+            "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(download_id)}/{quote(file_name)}",
+            "Content-Disposition": f"attachment; filename*=utf-8''{quote(file_name)}",
+            "Content-Type": "application/octet-stream",
+        })
+    
+    return LargeFileResponse(
         path=file_path,
         filename=file_name,
         media_type="application/octet-stream"
@@ -393,15 +735,40 @@ async def startup_event():
     
     # Initialize cache file
     init_cache_file()
+    threading.Thread(target=_flush_worker, name="cache-flush", daemon=True).start()
     
     # Clean up old files from previous runs
-    cleanup_old_files()
+    await cleanup_old_files()
     
-    # Start periodic cleanup task
-    asyncio.create_task(periodic_cleanup())
-    print("Periodic cleanup task started (runs every 5 minutes)")
+    # Schedule periodic cleanup
+    loop = asyncio.get_running_loop()
+    schedule_cleanup(loop, loop.time() + CLEANUP_INTERVAL)
+    print("Periodic cleanup scheduled (runs every 5 minutes)")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop periodic cleanup and write pending cache rows"""
+    if _cleanup_handle is not None:
+        _cleanup_handle.cancel()
+
+    # Stop a cleanup that is still running before the final flush
+    if _cleanup_task is not None and not _cleanup_task.done():
+        _cleanup_task.cancel()
+        try:
+            await _cleanup_task
+        except asyncio.CancelledError:
+            pass
+
+    await asyncio.to_thread(flush_cache)
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=5000,
+        # Download limits and INFO_CACHE are per worker, so default to a single process
+        workers=int(os.environ.get("WEB_CONCURRENCY", 1))
+    )